@@ -1,5 +1,10 @@
 # 必要なライブラリのインポート
-from openai import AzureOpenAI
+import os
+import sys
+import time
+import asyncio
+import argparse
+from openai import AzureOpenAI, AsyncAzureOpenAI, BadRequestError
 
 # Azure OpenAI Serviceの設定
 aoai_endpoint = "https://{Azure OpenAI Serviceのリソース名}.openai.azure.com/"
@@ -7,6 +12,12 @@ api_key = "{APIキー}"
 api_version = "{APIバージョン}"
 deployment_name = "{デプロイ名}"
 
+# 生成したトークン数を数えるときに使うトークナイザー(デプロイしたモデルに合わせる)
+encoding_name = "cl100k_base"
+
+# 小説の作者としてのシステムメッセージ
+system_message = "あなたは小説の作者です。与えられたプロンプトに基づいて、小説を作ってください。"
+
 # Azure OpenAI Serviceのクライアントの作成
 openai_client = AzureOpenAI(
     api_version=api_version,
@@ -19,19 +30,152 @@ def generate_story(prompt, max_tokens=500):
     response = openai_client.chat.completions.create(
         model=deployment_name,
         messages=[
-            {"role": "system", "content": "あなたは小説の作者です。与えられたプロンプトに基づいて、小説を作ってください。"},
+            {"role": "system", "content": system_message},
             {"role": "user", "content": prompt}
         ],
+        max_tokens=max_tokens,
     )
     story = response.choices[0].message.content
     return story
 
 
-# プロンプトの設定
-prompt = "ワクワクするような楽しいSF小説を作って。"
+# 小説をストリーミングで生成し、届いたトークンから順にファイルへ書き出す関数
+# n件のバリエーションを1回のリクエストで生成し、i番目のバリエーションはoutput_paths[i]に書き出す。
+# stream_supportはバッチ全体で共有する辞書で、APIがstream_optionsに対応しているかを記録する。
+async def generate_story_stream(async_client, prompt, output_paths, max_tokens=500, n=1, stream_support=None):
+    if stream_support is None:
+        stream_support = {"include_usage": True}
+    start = time.perf_counter()
+    first_token_time = None
+    texts = [[] for _ in output_paths]
+    usage = None
+
+    request = dict(
+        model=deployment_name,
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens,
+        n=n,
+        stream=True,
+    )
+    # stream_optionsでinclude_usageを指定すると、最後のチャンクで生成したトークン数が返される。
+    # 対応していない古いAPIバージョンではstream_optionsを指摘する400エラーになるため、その場合だけ
+    # stream_optionsを外して送り直し、以降のリクエストでは最初から外す。
+    # (コンテンツフィルターやパラメーターの誤りなど、ほかの400エラーはそのまま送出する)
+    if stream_support["include_usage"]:
+        try:
+            stream = await async_client.chat.completions.create(**request, stream_options={"include_usage": True})
+        except BadRequestError as e:
+            if e.param != "stream_options" and "stream_options" not in str(e.message):
+                raise
+            stream_support["include_usage"] = False
+            stream = await async_client.chat.completions.create(**request)
+    else:
+        stream = await async_client.chat.completions.create(**request)
+
+    files = [open(path, "w", encoding="utf-8") for path in output_paths]
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                if choice.delta is None or not choice.delta.content:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                files[choice.index].write(choice.delta.content)
+                files[choice.index].flush()
+                texts[choice.index].append(choice.delta.content)
+    finally:
+        for f in files:
+            f.close()
+
+    latency = time.perf_counter() - start
+    if usage is not None:
+        completion_tokens = usage.completion_tokens
+    else:
+        # トークン数が返されなかった場合は、生成した文章をトークナイザーで数える。
+        # (1つのチャンクに複数のトークンが入ることがあるため、チャンクの数では数えない)
+        # tiktokenはこの場合にしか使わないため、ここでインポートする。
+        import tiktoken
+        encoding = tiktoken.get_encoding(encoding_name)
+        completion_tokens = sum(len(encoding.encode("".join(text))) for text in texts)
+    return {
+        "latency": latency,
+        "time_to_first_token": (first_token_time - start) if first_token_time is not None else None,
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": completion_tokens / latency if latency > 0 else 0.0,
+    }
+
+
+# プロンプトのファイルを読み込み、同時実行数を制限しながら小説をまとめて生成する関数
+# プロンプトのファイルは1行に1つのプロンプトを書いたテキストファイルとする。
+async def generate_stories(prompt_file, output_dir, max_tokens=500, n=1, concurrency=4):
+    with open(prompt_file, encoding="utf-8") as f:
+        prompts = [line.strip() for line in f if line.strip()]
+
+    os.makedirs(output_dir, exist_ok=True)
+    async_client = AsyncAzureOpenAI(
+        api_version=api_version,
+        azure_endpoint=aoai_endpoint,
+        api_key=api_key
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    # stream_optionsに対応していないことがわかったら、以降のプロンプトでは最初から外して送る。
+    stream_support = {"include_usage": True}
+
+    # 1つのプロンプトを処理する。失敗しても、ほかのプロンプトの生成は続ける。
+    async def run(i, prompt):
+        output_paths = [os.path.join(output_dir, f"story_{i:04}_{variant}.txt") for variant in range(n)]
+        async with semaphore:
+            try:
+                stats = await generate_story_stream(async_client, prompt, output_paths, max_tokens, n, stream_support)
+            except Exception as e:
+                print(f"[{i}] 生成に失敗しました: {e}")
+                return None
+        ttft = f"{stats['time_to_first_token']:.2f}秒" if stats["time_to_first_token"] is not None else "-"
+        print(f"[{i}] レイテンシ: {stats['latency']:.2f}秒, 最初のトークンまで: {ttft}, "
+              f"トークン数: {stats['completion_tokens']}, {stats['tokens_per_second']:.1f}トークン/秒")
+        return stats
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.gather(*[run(i, prompt) for i, prompt in enumerate(prompts)])
+    finally:
+        await async_client.close()
+    elapsed = time.perf_counter() - start
+
+    # 全体の集計結果を表示する。
+    succeeded = [stats for stats in results if stats is not None]
+    total_tokens = sum(stats["completion_tokens"] for stats in succeeded)
+    latencies = sorted(stats["latency"] for stats in succeeded)
+    print(f"成功: {len(succeeded)}/{len(prompts)}件, 合計トークン数: {total_tokens}, "
+          f"全体のスループット: {total_tokens / elapsed if elapsed > 0 else 0.0:.1f}トークン/秒, 所要時間: {elapsed:.2f}秒")
+    if latencies:
+        print(f"レイテンシ 平均: {sum(latencies) / len(latencies):.2f}秒, "
+              f"中央値: {latencies[len(latencies) // 2]:.2f}秒, 最大: {latencies[-1]:.2f}秒")
+    return results
+
+
+if len(sys.argv) > 1:
+    # バッチモード: python generate_story.py prompts.txt --output-dir stories --concurrency 4 --n 2 --max-tokens 500
+    parser = argparse.ArgumentParser(description="プロンプトのファイルから小説をまとめて生成する")
+    parser.add_argument("prompt_file", help="1行に1つのプロンプトを書いたテキストファイル")
+    parser.add_argument("--output-dir", default="stories", help="生成した小説を書き出すディレクトリ")
+    parser.add_argument("--max-tokens", type=int, default=500, help="1つの小説で生成するトークン数の上限")
+    parser.add_argument("--n", type=int, default=1, help="1つのプロンプトから生成するバリエーションの数")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に送信するリクエストの数")
+    args = parser.parse_args()
+
+    asyncio.run(generate_stories(args.prompt_file, args.output_dir, args.max_tokens, args.n, args.concurrency))
+else:
+    # プロンプトの設定
+    prompt = "ワクワクするような楽しいSF小説を作って。"
 
-# 小説の生成
-story = generate_story(prompt)
+    # 小説の生成
+    story = generate_story(prompt)
 
-# 生成された小説の表示
-print(story)
\ No newline at end of file
+    # 生成された小説の表示
+    print(story)
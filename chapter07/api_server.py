@@ -0,0 +1,54 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from dotenv import load_dotenv
+from rag_engine import RagEngine
+
+# .envファイルから環境変数を読み込む。
+load_dotenv(verbose=True)
+
+# 同時に処理するリクエストの上限と、上限を超えたときにクライアントに再試行を促すまでの秒数
+MAX_IN_FLIGHT_REQUESTS = int(os.environ.get("MAX_IN_FLIGHT_REQUESTS", "32"))
+RETRY_AFTER_SECONDS = int(os.environ.get("RETRY_AFTER_SECONDS", "1"))
+
+# リクエストの本文の形式を定義する。
+# historyは[{'role': 'user', 'content': '有給は何日取れますか？'}, ...]というチャット履歴とする。
+# timeoutは回答までの締め切り(秒)とし、省略した場合はREQUEST_TIMEOUT_SECONDSを使う。
+class SearchRequest(BaseModel):
+    history: list[dict]
+    timeout: float | None = None
+
+# サーバーの起動時にRAGのエンジンを1つだけ生成し、すべてのリクエストで共有する。
+# こうすることで、同時に届いた質問の埋め込みのリクエストを1回のAPI呼び出しにまとめられる。
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.engine = RagEngine()
+    app.state.in_flight = asyncio.Semaphore(MAX_IN_FLIGHT_REQUESTS)
+    yield
+    await app.state.engine.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# ユーザーの質問に対して回答を生成するAPIを定義する。
+@app.post("/search")
+async def search(body: SearchRequest, request: Request):
+    # 処理中のリクエストが上限に達している場合は、待たせずに503を返して再試行を促す。
+    # 上限を超えたリクエストを溜め込まないことで、遅延が際限なく伸びるのを防ぐ。
+    in_flight = request.app.state.in_flight
+    if in_flight.locked():
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "処理中のリクエストが上限に達しています"},
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+
+    async with in_flight:
+        result = await request.app.state.engine.answer(body.history, body.timeout)
+    return {"answer": result["answer"], "sources": result["sources"], "degraded": result["degraded"]}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=os.environ.get("RAG_API_HOST", "127.0.0.1"), port=int(os.environ.get("RAG_API_PORT", "8000")))
@@ -0,0 +1,157 @@
+import os
+import json
+from array import array
+import numpy as np
+import tiktoken
+
+# チャンクストアを構成するファイル名
+META_FILE = "meta.json"  # チャンクの件数など
+TEXT_FILE = "text.bin"  # すべてのチャンクのテキストをUTF-8で連結したもの
+OFFSETS_FILE = "offsets.npy"  # i番目のチャンクのテキストはtext.binのoffsets[i]〜offsets[i+1]バイト目
+TOKEN_COUNTS_FILE = "token_counts.npy"  # チャンクごとのトークン数
+SOURCE_CODES_FILE = "source_codes.npy"  # チャンクごとの出典の番号(sources.jsonの何番目か)
+SOURCES_FILE = "sources.json"  # 出典(ファイル名やページのタイトルなど)の一覧
+HEADER_CODES_FILE = "header_codes.npy"  # チャンクごとの見出しの番号(headers.jsonの何番目か)
+HEADERS_FILE = "headers.json"  # 見出しのパス(「世界の歴史 > 古代文明」など)の一覧
+EMBEDDINGS_FILE = "embeddings.npy"  # チャンクごとのベクトル(チャンク数×次元数のfloat32の行列)
+
+# トークン数を数えるためのエンコーディング名
+DEFAULT_ENCODING_NAME = "cl100k_base"
+
+# 出典や見出しのように同じ値が繰り返し現れる列を、番号と値の一覧に分けて保持するクラスを定義する。
+class Dictionary:
+    def __init__(self, values: list = None):
+        self.values = values or []
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def encode(self, value: str):
+        if value not in self.codes:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        return self.codes[value]
+
+# チャンクストアにチャンクを書き込むクラスを定義する。
+# テキストは追加するたびにファイルの末尾に書き足し、オフセットなどの列はclose()の際にまとめて保存する。
+# 既存のチャンクストアに書き直す場合は、古いベクトルと件数の情報を先に削除する。
+# (残しておくと、新しいチャンクに古いベクトルが対応付けられたり、書き込みが途中で失敗したストアを読み込めてしまうため)
+class ChunkStoreWriter:
+    def __init__(self, path: str, encoding_name: str = DEFAULT_ENCODING_NAME):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        for name in (EMBEDDINGS_FILE, META_FILE):
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        self.encoding = tiktoken.get_encoding(encoding_name)
+        self.text_file = open(os.path.join(path, TEXT_FILE), "wb")
+        self.offsets = array("q", [0])
+        self.token_counts = array("i")
+        self.source_codes = array("i")
+        self.header_codes = array("i")
+        self.sources = Dictionary()
+        self.headers = Dictionary()
+
+    def __enter__(self):
+        return self
+
+    # 書き込み中に例外が発生した場合は、テキストのファイルを閉じるだけにし、
+    # 件数などの情報は保存しない(途中までのチャンクストアを読み込めないようにする)。
+    def __exit__(self, *exc_info):
+        if exc_info[0] is not None:
+            self.text_file.close()
+            return
+        self.close()
+
+    # チャンクを1件追加する。
+    def add(self, text: str, source: str = "", header_path: str = ""):
+        data = text.encode("utf-8")
+        self.text_file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+        self.token_counts.append(len(self.encoding.encode(text)))
+        self.source_codes.append(self.sources.encode(source))
+        self.header_codes.append(self.headers.encode(header_path))
+
+    def close(self):
+        self.text_file.close()
+        np.save(os.path.join(self.path, OFFSETS_FILE), np.frombuffer(self.offsets, dtype=np.int64))
+        np.save(os.path.join(self.path, TOKEN_COUNTS_FILE), np.frombuffer(self.token_counts, dtype=np.int32))
+        np.save(os.path.join(self.path, SOURCE_CODES_FILE), np.frombuffer(self.source_codes, dtype=np.int32))
+        np.save(os.path.join(self.path, HEADER_CODES_FILE), np.frombuffer(self.header_codes, dtype=np.int32))
+        with open(os.path.join(self.path, SOURCES_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.sources.values, f, ensure_ascii=False)
+        with open(os.path.join(self.path, HEADERS_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.headers.values, f, ensure_ascii=False)
+        with open(os.path.join(self.path, META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"count": len(self.token_counts)}, f)
+
+# チャンクストアを読み込むクラスを定義する。
+# どのファイルもメモリマップで開くため、全体をメモリに読み込まずに必要なチャンクだけを取り出せる。
+class ChunkStore:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        self.token_counts = np.load(os.path.join(path, TOKEN_COUNTS_FILE), mmap_mode="r")
+        self.source_codes = np.load(os.path.join(path, SOURCE_CODES_FILE), mmap_mode="r")
+        self.header_codes = np.load(os.path.join(path, HEADER_CODES_FILE), mmap_mode="r")
+        with open(os.path.join(path, SOURCES_FILE), encoding="utf-8") as f:
+            self.sources = json.load(f)
+        with open(os.path.join(path, HEADERS_FILE), encoding="utf-8") as f:
+            self.headers = json.load(f)
+
+        # 空のファイルはメモリマップできないため、チャンクがない場合は空の配列にする。
+        text_path = os.path.join(path, TEXT_FILE)
+        if os.path.getsize(text_path) > 0:
+            self.text_buffer = np.memmap(text_path, dtype=np.uint8, mode="r")
+        else:
+            self.text_buffer = np.empty(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    # i番目のチャンクのテキストを返す。
+    def text(self, i: int):
+        return self.text_buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    # i番目のチャンクの出典を返す。
+    def source(self, i: int):
+        return self.sources[self.source_codes[i]]
+
+    # i番目のチャンクの見出しのパスを返す。
+    def header_path(self, i: int):
+        return self.headers[self.header_codes[i]]
+
+    # i番目のチャンクのトークン数を返す。
+    def token_count(self, i: int):
+        return int(self.token_counts[i])
+
+    # チャンクのテキストをbatch_size件ずつ順に返す。
+    # 戻り値は(先頭のチャンクの番号, テキストのリスト)の組とする。
+    def iter_batches(self, batch_size: int = 16):
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            yield start, [self.text(i) for i in range(start, stop)]
+
+    # ベクトルを格納する行列を、チャンク数×次元数のfloat32のメモリマップとして新しく作成する。
+    def create_embeddings(self, dimensions: int):
+        return np.lib.format.open_memmap(
+            os.path.join(self.path, EMBEDDINGS_FILE), mode="w+", dtype=np.float32,
+            shape=(len(self), dimensions)
+        )
+
+    # 保存済みのベクトルの行列を、メモリマップとして開く。
+    # ベクトルの件数がチャンク数と一致しない場合は、ほかのチャンクのベクトルと取り違えないよう例外を送出する。
+    def embeddings(self, mode: str = "r"):
+        embeddings = np.load(os.path.join(self.path, EMBEDDINGS_FILE), mmap_mode=mode)
+        if embeddings.shape[0] != len(self):
+            raise ValueError(f"ベクトルの件数({embeddings.shape[0]})がチャンク数({len(self)})と一致しません。ベクトルを作り直してください")
+        return embeddings
+
+    # 保存済みのベクトルを、(idのリスト, ベクトルの行列)の組としてbatch_size件ずつ順に返す。
+    # idはチャンクの番号とし、vector_store.pyのbuild_storeにそのまま渡せる形式にする。
+    def iter_embedding_batches(self, batch_size: int = 65536):
+        embeddings = self.embeddings()
+        for start in range(0, len(self), batch_size):
+            stop = min(start + batch_size, len(self))
+            yield [str(i) for i in range(start, stop)], embeddings[start:stop]
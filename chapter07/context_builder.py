@@ -0,0 +1,113 @@
+import tiktoken
+
+# トークン数を数えるためのエンコーディング名（GPT-4系・GPT-3.5系のモデルはcl100k_baseを使う）
+DEFAULT_ENCODING_NAME = "cl100k_base"
+
+# 情報源1つ分として詰め込む価値がある最小のトークン数
+# 予算の残りがこれより少ない場合は、途中で切り詰めた情報源を追加しない。
+MIN_SOURCE_TOKENS = 50
+
+# インデクサーがチャンク化する際に指定しているオーバーラップの文字数
+# 隣り合うチャンクの重なりは、この長さを超えることはない。
+CHUNK_OVERLAP = 200
+
+# 同じドキュメントの隣り合うチャンク同士で、重なっている文字列の長さを求める関数を定義する。
+# 前のチャンクの末尾と後ろのチャンクの先頭が一致している最大の長さを返す。
+def find_overlap(previous: str, following: str, max_overlap: int = None):
+    limit = min(len(previous), len(following))
+    if max_overlap is not None:
+        limit = min(limit, max_overlap)
+
+    for length in range(limit, 0, -1):
+        if previous.endswith(following[:length]):
+            return length
+    return 0
+
+# 検索結果のうち、同じドキュメントの連続したチャンクを1つの範囲にまとめる関数を定義する。
+# chapter07のインデクサーは1つのドキュメントを先頭から順にチャンク化し、
+# その番号をidとして登録しているため、idが連続していれば隣り合うチャンクとみなせる。
+def merge_adjacent_chunks(results: list, max_overlap: int = CHUNK_OVERLAP):
+    # 検索順位を保ったまま、idの番号順に並べ替える。
+    ranked = [(rank, result) for rank, result in enumerate(results)]
+    numbered = sorted(
+        [(int(result["id"]), rank, result) for rank, result in ranked if str(result["id"]).isdigit()],
+        key=lambda item: item[0]
+    )
+    others = [(rank, result) for rank, result in ranked if not str(result["id"]).isdigit()]
+
+    spans = []
+    for number, rank, result in numbered:
+        last = spans[-1] if spans else None
+        if last is not None and number == last["last_number"] + 1:
+            # 直前のチャンクと重なっている部分を取り除いてから連結する。
+            overlap = find_overlap(last["content"], result["content"], max_overlap)
+            last["content"] += result["content"][overlap:]
+            last["ids"].append(str(result["id"]))
+            last["last_number"] = number
+            last["rank"] = min(last["rank"], rank)
+        else:
+            spans.append({
+                "ids": [str(result["id"])],
+                "content": result["content"],
+                "last_number": number,
+                "rank": rank
+            })
+
+    for rank, result in others:
+        spans.append({"ids": [str(result["id"])], "content": result["content"], "last_number": None, "rank": rank})
+
+    # 検索順位が高いチャンクを含む範囲から順に並べ直す。
+    spans.sort(key=lambda span: span["rank"])
+    return spans
+
+# 情報源の見出しを作る関数を定義する。
+# 連結した範囲は[Source3-4]のように、先頭と末尾のidを並べて表す。
+def format_source(span: dict):
+    ids = span["ids"]
+    label = ids[0] if len(ids) == 1 else ids[0] + "-" + ids[-1]
+    return "[Source" + label + "]: " + span["content"]
+
+# 検索結果をトークン数の予算内に収まるように詰め込み、プロンプトに埋め込む情報源を作る関数を定義する。
+# 戻り値は情報源のリストと、重なりの除去で削減できたトークン数・予算を超えて削ったトークン数などの統計情報とする。
+def build_context(results: list, token_budget: int, encoding_name: str = DEFAULT_ENCODING_NAME, max_overlap: int = CHUNK_OVERLAP):
+    encoding = tiktoken.get_encoding(encoding_name)
+    results = list(results)
+
+    # 何も加工せずにすべてのチャンクを連結した場合のトークン数（比較用）
+    naive_sources = ["[Source" + str(result["id"]) + "]: " + result["content"] for result in results]
+    naive_tokens = len(encoding.encode("\n".join(naive_sources)))
+
+    # 隣り合うチャンクの重なりを取り除いた後のトークン数（予算で削る前）
+    merged_sources = [format_source(span) for span in merge_adjacent_chunks(results, max_overlap)]
+    merged_tokens = len(encoding.encode("\n".join(merged_sources)))
+
+    # 重なりを取り除いた情報源を、検索順位の高い順に予算内へ詰め込む。
+    sources = []
+    used_tokens = 0
+    newline_tokens = len(encoding.encode("\n"))
+    for source in merged_sources:
+        tokens = encoding.encode(source)
+        separator_tokens = newline_tokens if sources else 0
+        remaining = token_budget - used_tokens - separator_tokens
+
+        if len(tokens) <= remaining:
+            sources.append(source)
+            used_tokens += separator_tokens + len(tokens)
+        elif remaining >= MIN_SOURCE_TOKENS:
+            # 入りきらない情報源は、予算の残りに収まる長さまで切り詰める。
+            # マルチバイト文字の途中で切れた場合に残る置換文字は取り除く。
+            sources.append(encoding.decode(tokens[:remaining]).rstrip("\ufffd"))
+            used_tokens += separator_tokens + remaining
+            break
+        else:
+            break
+
+    stats = {
+        "naive_tokens": naive_tokens,
+        "merged_tokens": merged_tokens,
+        "context_tokens": used_tokens,
+        "overlap_saved_tokens": naive_tokens - merged_tokens,  # 重なりの除去で削減できたトークン数
+        "budget_dropped_tokens": max(0, merged_tokens - used_tokens),  # 予算に収めるために削ったトークン数
+        "sources": len(sources)
+    }
+    return sources, stats
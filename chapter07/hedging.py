@@ -0,0 +1,94 @@
+import time
+import asyncio
+from collections import deque
+import numpy as np
+
+# リクエスト全体の締め切りを表すクラスを定義する。
+# 検索や回答生成などの各段階は、このクラスから残り時間を受け取って処理する。
+class Deadline:
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    # 締め切りまでの残り時間(秒)を返す。締め切りを過ぎている場合は0を返す。
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    # 残り時間のうち、指定した割合だけを持つ締め切りを作る。
+    # 例えば検索に残り時間の4割を割り当て、残りを回答生成に回すといった使い方をする。
+    def split(self, ratio: float):
+        return Deadline(self.remaining() * ratio)
+
+# 直近の処理時間を記録し、パーセンタイル値を求めるクラスを定義する。
+# 記録が少ないうちはパーセンタイル値が安定しないため、既定の値を返す。
+class LatencyTracker:
+    def __init__(self, default_seconds: float, min_samples: int = 20, max_samples: int = 200):
+        self.default_seconds = default_seconds
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=max_samples)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, percentile: float):
+        if len(self.samples) < self.min_samples:
+            return self.default_seconds
+        return float(np.percentile(self.samples, percentile))
+
+# ヘッジ付きで非同期の処理を呼び出す関数を定義する。
+# 最初の呼び出しが、これまでの処理時間のpercentileパーセンタイル値を過ぎても終わらない場合は、
+# 同じ処理をもう1つ呼び出し、先に成功した方の結果を使う(遅い方は取り消す)。
+# timeout秒以内にどちらも終わらない場合は、asyncio.TimeoutErrorを送出する。
+# trackerには、ヘッジの待ち時間を含まない各呼び出し自身の処理時間を記録する。
+# 失敗した呼び出しも記録し、締め切りまでに終わらなかった呼び出しや、もう一方が先に成功して取り消した呼び出しは、
+# 取り消すまでの時間を(実際の処理時間の下限として)記録する。
+# (遅い呼び出しを記録から外すと、パーセンタイル値が実際より小さくなり、ヘッジを送りすぎてしまうため)。
+async def hedged(call, tracker: LatencyTracker, percentile: float, timeout: float):
+    if timeout <= 0:
+        raise asyncio.TimeoutError()
+
+    start = time.monotonic()
+    deadline = start + timeout
+    started = {}  # 呼び出しごとの開始時刻
+
+    def launch():
+        task = asyncio.ensure_future(call())
+        started[task] = time.monotonic()
+        return task
+
+    tasks = {launch()}
+    hedge_delay = tracker.percentile(percentile)
+    last_error = None
+    try:
+        while tasks:
+            # バックアップをまだ送っていない場合は、ヘッジの待ち時間までで一旦区切る。
+            wait_until = deadline
+            can_hedge = hedge_delay is not None
+            if can_hedge:
+                wait_until = min(deadline, start + hedge_delay)
+
+            done, _ = await asyncio.wait(
+                tasks, timeout=max(0.0, wait_until - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                tasks.discard(task)
+                tracker.record(time.monotonic() - started[task])
+                if task.exception() is None:
+                    return task.result()
+                last_error = task.exception()
+
+            if can_hedge and time.monotonic() < deadline:
+                # ヘッジの待ち時間を過ぎた(または最初の呼び出しが失敗した)ので、バックアップを送る。
+                tasks.add(launch())
+                hedge_delay = None
+            elif not done and time.monotonic() >= deadline:
+                raise asyncio.TimeoutError()
+
+        raise last_error
+    finally:
+        now = time.monotonic()
+        for task in tasks:
+            tracker.record(now - started[task])
+            task.cancel()
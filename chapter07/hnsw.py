@@ -0,0 +1,138 @@
+import heapq
+import math
+import numpy as np
+
+# パラメーターの比較用に、HNSW(Hierarchical Navigable Small World)を手元で動かすためのクラスを定義する。
+# Azure AI Searchのベクトル検索と同じく、m・efConstruction・efSearchの3つのパラメーターを持つ。
+# ベクトルは長さ1に正規化して保持し、内積(=コサイン類似度)が大きいほど近いものとする。
+class HNSWIndex:
+    def __init__(self, dim: int, m: int = 4, ef_construction: int = 400, seed: int = 0):
+        self.dim = dim
+        self.m = m  # 各ノードが上位の層で持つ隣接ノードの数(最下層ではその2倍)
+        self.ef_construction = ef_construction  # グラフを作る際に調べる候補の数
+        self.level_mult = 1 / math.log(max(m, 2))
+        self.rng = np.random.default_rng(seed)
+
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+        self.layers = []  # 層ごとに「ノード番号 -> 隣接ノードのリスト」を保持する
+        self.entry_point = None
+        self.max_level = -1
+
+    def __len__(self):
+        return len(self.vectors)
+
+    # ノードの層ごとの隣接ノード数の上限を返す。
+    def max_neighbors(self, level: int):
+        return self.m * 2 if level == 0 else self.m
+
+    # 1つの層の中で、質問に近いノードをef件探す。
+    # 戻り値は(類似度, ノード番号)のリストで、類似度の高い順に並べたものとする。
+    def search_layer(self, query, entry_points: list, ef: int, level: int):
+        graph = self.layers[level]
+        scores = self.vectors[entry_points] @ query
+        visited = set(entry_points)
+        candidates = [(-score, node) for score, node in zip(scores.tolist(), entry_points)]  # 近い順に取り出す
+        heapq.heapify(candidates)
+        found = [(score, node) for score, node in zip(scores.tolist(), entry_points)]  # 遠い順に取り出す
+        heapq.heapify(found)
+        while len(found) > ef:
+            heapq.heappop(found)
+
+        while candidates:
+            negative_score, node = heapq.heappop(candidates)
+            if -negative_score < found[0][0] and len(found) >= ef:
+                break
+            neighbors = [neighbor for neighbor in graph.get(node, []) if neighbor not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            # 隣接ノードとの類似度は、行列演算でまとめて計算する。
+            neighbor_scores = self.vectors[neighbors] @ query
+            for score, neighbor in zip(neighbor_scores.tolist(), neighbors):
+                if len(found) < ef or score > found[0][0]:
+                    heapq.heappush(candidates, (-score, neighbor))
+                    heapq.heappush(found, (score, neighbor))
+                    if len(found) > ef:
+                        heapq.heappop(found)
+
+        return sorted(found, reverse=True)
+
+    # 候補の中から隣接ノードをlimit件まで選ぶ。
+    # 単純に近い順に選ぶとクラスタの間をつなぐ辺がなくなるため、HNSWの論文のヒューリスティックに従い、
+    # 選択済みのどのノードよりも基準のノードに近い候補だけを選ぶ。
+    def select_neighbors(self, base, candidates: list, limit: int):
+        scores = self.vectors[candidates] @ base
+        selected = []
+        for i in np.argsort(-scores):
+            if len(selected) >= limit:
+                break
+            candidate = candidates[i]
+            if selected and np.max(self.vectors[selected] @ self.vectors[candidate]) > scores[i]:
+                continue
+            selected.append(candidate)
+        return selected
+
+    # 隣接ノードの上限を超えた場合に、残す隣接ノードを選び直す。
+    def shrink(self, node: int, level: int):
+        neighbors = self.layers[level][node]
+        limit = self.max_neighbors(level)
+        if len(neighbors) > limit:
+            self.layers[level][node] = self.select_neighbors(self.vectors[node], neighbors, limit)
+
+    # ベクトルの行列をまとめてグラフに追加する。
+    def add(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        start = len(self.vectors)
+        self.vectors = np.concatenate([self.vectors, vectors])
+
+        for node in range(start, len(self.vectors)):
+            query = self.vectors[node]
+            level = int(-math.log(1 - self.rng.random()) * self.level_mult)
+            while len(self.layers) <= level:
+                self.layers.append({})
+
+            if self.entry_point is None:
+                for current in range(level + 1):
+                    self.layers[current][node] = []
+                self.entry_point, self.max_level = node, level
+                continue
+
+            # 上の層から順に、貪欲法で最も近いノードまで降りていく。
+            entry_points = [self.entry_point]
+            for current in range(self.max_level, level, -1):
+                entry_points = [self.search_layer(query, entry_points, 1, current)[0][1]]
+
+            # 追加するノードの層以下では、ef_construction件の候補から隣接ノードを選んで双方向につなぐ。
+            for current in range(min(level, self.max_level), -1, -1):
+                found = self.search_layer(query, entry_points, self.ef_construction, current)
+                neighbors = self.select_neighbors(query, [neighbor for _, neighbor in found], self.max_neighbors(current))
+                self.layers[current][node] = neighbors
+                for neighbor in neighbors:
+                    self.layers[current][neighbor].append(node)
+                    self.shrink(neighbor, current)
+                entry_points = [neighbor for _, neighbor in found]
+
+            for current in range(self.max_level + 1, level + 1):
+                self.layers[current][node] = []
+            if level > self.max_level:
+                self.entry_point, self.max_level = node, level
+
+    # 質問に近いノードを上位k件検索する。戻り値は(ノード番号, 類似度)のリストとする。
+    def search(self, query_vector, k: int = 3, ef_search: int = 500):
+        if self.entry_point is None:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        entry_points = [self.entry_point]
+        for current in range(self.max_level, 0, -1):
+            entry_points = [self.search_layer(query, entry_points, 1, current)[0][1]]
+        found = self.search_layer(query, entry_points, max(ef_search, k), 0)
+        return [(node, score) for score, node in found[:k]]
+
+    # ベクトルとグラフのメモリ使用量(バイト数)の見積もりを返す。
+    # 隣接ノードの番号は、実際のHNSWの実装と同じく4バイトの整数で持つものとして数える。
+    def memory_usage(self):
+        edges = sum(len(neighbors) for layer in self.layers for neighbors in layer.values())
+        return {"vectors": int(self.vectors.nbytes), "graph": edges * 4}
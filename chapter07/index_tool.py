@@ -0,0 +1,202 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.indexes import SearchIndexClient
+from azure.search.documents.indexes.models import (
+    SearchIndex,
+    SimpleField,
+    SearchableField,
+    SearchField,
+    SearchFieldDataType,
+    VectorSearch,
+    VectorSearchProfile,
+    HnswAlgorithmConfiguration,
+    HnswParameters,
+)
+from dotenv import load_dotenv
+from hnsw import HNSWIndex
+from vector_store import QuantizedVectorStore, embed_questions, normalize
+
+# .envファイルから環境変数を読み込む。
+load_dotenv(verbose=True)
+
+# 環境変数から各種Azureリソースへの接続情報を取得する。
+SEARCH_SERVICE_ENDPOINT = os.environ.get("SEARCH_SERVICE_ENDPOINT") # Azure AI Searchのエンドポイント
+SEARCH_SERVICE_API_KEY = os.environ.get("SEARCH_SERVICE_API_KEY") # Azure AI SearchのAPIキー
+SEARCH_SERVICE_INDEX_NAME = os.environ.get("SEARCH_SERVICE_INDEX_NAME") # Azure AI Searchのインデックス名
+
+# HNSWのパラメーターの既定値（Azure AI Searchの既定値と同じ）
+DEFAULT_M = 4
+DEFAULT_EF_CONSTRUCTION = 400
+DEFAULT_EF_SEARCH = 500
+
+# パラメーターを比較するのに必要な最小のベクトル数
+# これより少ない場合は、どのパラメーターでもほぼ全件を調べることになり比較にならない。
+MIN_SWEEP_VECTORS = 20
+
+# インデックスのスキーマを作成する関数を定義する。
+# chapter07のインデクサーはcontextVector、chapter08のハイブリッド検索はcontentVectorとtitleを使うため、
+# ベクトルのフィールド名とtitleフィールドの有無を引数で切り替えられるようにする。
+def create_index_schema(index_name: str, dimensions: int = 1536, vector_field: str = "contextVector",
+                        with_title: bool = False, m: int = DEFAULT_M,
+                        ef_construction: int = DEFAULT_EF_CONSTRUCTION, ef_search: int = DEFAULT_EF_SEARCH):
+    fields = [
+        SimpleField(name="id", type=SearchFieldDataType.String, key=True),
+        # キーワード検索(ハイブリッド検索を含む)で日本語を正しく扱えるよう、日本語のアナライザーを指定する。
+        SearchableField(name="content", type=SearchFieldDataType.String, analyzer_name="ja.microsoft"),
+        # MMRの計算で候補のベクトルを取得できるよう、ベクトルのフィールドも取得可能にしておく。
+        SearchField(
+            name=vector_field,
+            type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+            searchable=True,
+            hidden=False,
+            vector_search_dimensions=dimensions,
+            vector_search_profile_name="vector-profile"
+        ),
+    ]
+    if with_title:
+        fields.insert(1, SearchableField(name="title", type=SearchFieldDataType.String, analyzer_name="ja.microsoft"))
+
+    # ベクトル検索に使うHNSWのパラメーターを明示的に指定する。
+    vector_search = VectorSearch(
+        algorithms=[
+            HnswAlgorithmConfiguration(
+                name="hnsw-config",
+                parameters=HnswParameters(
+                    m=m,
+                    ef_construction=ef_construction,
+                    ef_search=ef_search,
+                    metric="cosine"
+                )
+            )
+        ],
+        profiles=[VectorSearchProfile(name="vector-profile", algorithm_configuration_name="hnsw-config")]
+    )
+
+    return SearchIndex(name=index_name, fields=fields, vector_search=vector_search)
+
+# Azure AI Searchにインデックスを作成(既にある場合は更新)する関数を定義する。
+def create_index(index: SearchIndex):
+    index_client = SearchIndexClient(
+        endpoint=SEARCH_SERVICE_ENDPOINT,
+        credential=AzureKeyCredential(SEARCH_SERVICE_API_KEY)
+    )
+    return index_client.create_or_update_index(index)
+
+# 上位k件の正解と比べた再現率を計算する関数を定義する。
+def recall_at_k(found: list, exact: list):
+    # 正解が1件もない場合は、再現率を定義できないため1.0とみなす。
+    if not exact:
+        return 1.0
+    return len(set(found) & set(exact)) / len(exact)
+
+# HNSWのパラメーターを組み合わせて、構築時間・メモリ・検索の遅延・再現率を計測する関数を定義する。
+# efSearchは検索時だけに使うパラメーターなので、mとefConstructionの組み合わせごとに1度だけグラフを作る。
+def sweep(vectors: np.ndarray, queries: np.ndarray, m_values: list, ef_construction_values: list,
+          ef_search_values: list, k: int = 3):
+    vectors = normalize(np.asarray(vectors, dtype=np.float32))
+    queries = normalize(np.asarray(queries, dtype=np.float32))
+
+    # 全件を調べた場合の正解の上位k件
+    exact = [np.argsort(-(vectors @ query))[:k].tolist() for query in queries]
+
+    reports = []
+    for m in m_values:
+        for ef_construction in ef_construction_values:
+            start = time.perf_counter()
+            index = HNSWIndex(vectors.shape[1], m=m, ef_construction=ef_construction)
+            index.add(vectors)
+            build_seconds = time.perf_counter() - start
+            memory = index.memory_usage()
+
+            for ef_search in ef_search_values:
+                latencies, recalls = [], []
+                for query, answer in zip(queries, exact):
+                    start = time.perf_counter()
+                    found = [node for node, _ in index.search(query, k, ef_search)]
+                    latencies.append(time.perf_counter() - start)
+                    recalls.append(recall_at_k(found, answer))
+
+                latencies_ms = np.asarray(latencies) * 1000
+                reports.append({
+                    "m": m,
+                    "efConstruction": ef_construction,
+                    "efSearch": ef_search,
+                    "build_seconds": build_seconds,
+                    "graph_bytes": memory["graph"],
+                    "vector_bytes": memory["vectors"],
+                    "p50_ms": float(np.percentile(latencies_ms, 50)),
+                    "p99_ms": float(np.percentile(latencies_ms, 99)),
+                    f"recall@{k}": float(np.mean(recalls))
+                })
+    return reports
+
+# 計測結果を表形式で表示する関数を定義する。
+def print_reports(reports: list):
+    headers = list(reports[0].keys())
+    print("\t".join(headers))
+    for report in reports:
+        print("\t".join(f"{report[h]:.3f}" if isinstance(report[h], float) else str(report[h]) for h in headers))
+
+# カンマ区切りの数値の文字列をリストに変換する関数を定義する。
+def int_list(value: str):
+    return [int(v) for v in value.split(",")]
+
+if __name__ == "__main__":
+    # 使い方:
+    #   python index_tool.py create [--m 4] [--ef-construction 400] [--ef-search 500] [--dimensions 1536]
+    #                               [--vector-field contextVector] [--with-title]
+    #   python index_tool.py sweep <ベクトルストアの保存先> [--questions 質問のCSVファイル]
+    #                              [--m 4,8,16] [--ef-construction 100,400] [--ef-search 50,100,500]
+    parser = argparse.ArgumentParser(description="インデックスの作成とHNSWのパラメーターの比較を行う")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create", help="インデックスのスキーマを作成する")
+    create_parser.add_argument("--index-name", default=SEARCH_SERVICE_INDEX_NAME)
+    create_parser.add_argument("--dimensions", type=int, default=1536)
+    create_parser.add_argument("--vector-field", default="contextVector")
+    create_parser.add_argument("--with-title", action="store_true")
+    create_parser.add_argument("--m", type=int, default=DEFAULT_M)
+    create_parser.add_argument("--ef-construction", type=int, default=DEFAULT_EF_CONSTRUCTION)
+    create_parser.add_argument("--ef-search", type=int, default=DEFAULT_EF_SEARCH)
+
+    sweep_parser = subparsers.add_parser("sweep", help="HNSWのパラメーターを変えて性能を比較する")
+    sweep_parser.add_argument("store", help="vector_store.pyで作成したベクトルストアの保存先")
+    sweep_parser.add_argument("--questions", help="generate_eval_data.pyと同じ形式の質問のCSVファイル")
+    sweep_parser.add_argument("--m", type=int_list, default=[4, 8, 16])
+    sweep_parser.add_argument("--ef-construction", type=int_list, default=[100, 400])
+    sweep_parser.add_argument("--ef-search", type=int_list, default=[50, 100, 500])
+    sweep_parser.add_argument("--k", type=int, default=3)
+
+    args = parser.parse_args()
+
+    if args.command == "create":
+        index = create_index_schema(
+            args.index_name,
+            dimensions=args.dimensions,
+            vector_field=args.vector_field,
+            with_title=args.with_title,
+            m=args.m,
+            ef_construction=args.ef_construction,
+            ef_search=args.ef_search
+        )
+        create_index(index)
+        print(f"インデックス{args.index_name}を作成しました (m={args.m}, efConstruction={args.ef_construction}, efSearch={args.ef_search})")
+    else:
+        store = QuantizedVectorStore(args.store)
+        vectors = np.asarray(store.vectors)
+        if args.questions:
+            queries = embed_questions(args.questions)
+        else:
+            # 質問が指定されない場合は、登録済みのベクトルの1割(最大100件)を取り出して質問の代わりに使い、
+            # 残りのベクトルでグラフを作る。
+            holdout = max(1, min(100, len(vectors) // 10))
+            rows = np.random.default_rng(0).permutation(len(vectors))
+            queries, vectors = vectors[rows[:holdout]], vectors[np.sort(rows[holdout:])]
+        if len(vectors) < MIN_SWEEP_VECTORS:
+            print(f"ベクトルが{len(vectors)}件しかないため比較できません(グラフには{MIN_SWEEP_VECTORS}件以上が必要です)")
+            sys.exit(1)
+        print_reports(sweep(vectors, queries, args.m, args.ef_construction, args.ef_search, args.k))
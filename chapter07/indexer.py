@@ -6,6 +6,7 @@ from openai import AzureOpenAI
 from pypdf import PdfReader
 from azure.core.credentials import AzureKeyCredential
 from dotenv import load_dotenv
+from chunk_store import ChunkStore, ChunkStoreWriter
 
 # .envファイルから環境変数を読み込む。
 load_dotenv(verbose=True)
@@ -23,8 +24,8 @@ AOAI_EMBEDDING_MODEL_NAME = os.environ.get("AOAI_EMBEDDING_MODEL_NAME") # Azure
 separator = ["\n\n", "\n", "。", "、", " ", ""]
 
 # チャンクをインデクシングする関数を定義する。
-# 引数はチャンクのリストとする。
-def index_docs(chunks: list):
+# 引数はチャンクストアとし、batch_size件ずつまとめてベクトル化する。
+def index_docs(store: ChunkStore, batch_size: int = 16):
     # Azure AI SearchのAPIに接続するためのクライアントを生成する。
     searchClient = SearchClient(
         endpoint=SEARCH_SERVICE_ENDPOINT,
@@ -40,19 +41,31 @@ def index_docs(chunks: list):
     )
 
 
-    # 引数によって渡されたチャンクのリストをベクトル化して、Azure AI Searchに登録する。
-    for i, chunk in enumerate(chunks):
-        print(f"{i+1}個目のチャンクを処理中...")
+    # チャンクストアのチャンクをベクトル化して、Azure AI Searchに登録する。
+    # ベクトルはチャンクストアにも保存し、後からほかの処理で再利用できるようにする。
+    embeddings = None
+    for start, chunks in store.iter_batches(batch_size):
+        print(f"{start+1}〜{start+len(chunks)}個目のチャンクを処理中...")
         response = openAIClient.embeddings.create(
-            input = chunk,
+            input = chunks,
             model = AOAI_EMBEDDING_MODEL_NAME
         )
+        vectors = [data.embedding for data in response.data]
+        if embeddings is None:
+            embeddings = store.create_embeddings(len(vectors[0]))
+        embeddings[start:start + len(vectors)] = vectors
 
         # チャンクのテキストと、そのチャンクをベクトル化したものをAzure AI Searchに登録する。
         # 間違えてcontextVectorにしてしまったので書き換える。
         # document = {"id": str(i), "content": chunk, "contentVector": response.data[0].embedding}
-        document = {"id": str(i), "content": chunk, "contextVector": response.data[0].embedding}
-        searchClient.upload_documents([document])
+        documents = [
+            {"id": str(start + i), "content": chunk, "contextVector": vector}
+            for i, (chunk, vector) in enumerate(zip(chunks, vectors))
+        ]
+        searchClient.upload_documents(documents)
+
+    if embeddings is not None:
+        embeddings.flush()
 
 # テキストを指定したサイズで分割する関数を定義する。
 def create_chunk(content: str, separator: str, chunk_size: int = 1000, overlap: int = 200):
@@ -78,20 +91,25 @@ def extract_text_from_docs(filepath):
 
 if __name__ == "__main__":
     # インデクサーのコマンドライン引数からドキュメントのファイルパスを取得する。
+    # 2つ目の引数でチャンクストアの保存先を指定できる(省略した場合はchunks)。
     if len(sys.argv) < 2:
         print("ドキュメントのファイルパスを指定してください")
         sys.exit(1)
 
     filename = sys.argv[1]
+    store_path = sys.argv[2] if len(sys.argv) > 2 else "chunks"
 
     # ドキュメントからテキストを抽出する。
     content = extract_text_from_docs(filename)
 
-    # ドキュメントから抽出したテキストをチャンクに分割する。
+    # ドキュメントから抽出したテキストをチャンクに分割し、チャンクストアに保存する。
     chunks = create_chunk(content, separator)
+    with ChunkStoreWriter(store_path) as writer:
+        for chunk in chunks:
+            writer.add(chunk, source=os.path.basename(filename))
 
     # チャンクをAzure AI Searchにインデックスする
-    index_docs(chunks)
+    index_docs(ChunkStore(store_path))
 
     print("インデックスの作成が完了しました")
 
@@ -0,0 +1,38 @@
+import numpy as np
+
+# ベクトルを長さ1に正規化する関数を定義する。
+# 正規化しておくと、内積がそのままコサイン類似度になる。
+def normalize(vectors: np.ndarray):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+# Maximal Marginal Relevance(MMR)で、候補の中から多様性のある上位top_n件を選ぶ関数を定義する。
+# 引数は質問のベクトル、候補のベクトルの行列(候補数×次元数)、選ぶ件数、関連度と多様性の重みとする。
+# 戻り値は選ばれた候補のインデックスのリスト(選ばれた順)とする。
+def maximal_marginal_relevance(query_vector, candidate_vectors, top_n: int = 3, lambda_mult: float = 0.5):
+    candidates = normalize(np.asarray(candidate_vectors, dtype=np.float32))
+    query = normalize(np.asarray(query_vector, dtype=np.float32))
+    top_n = min(top_n, len(candidates))
+    if top_n <= 0:
+        return []
+
+    # 質問と各候補の類似度、候補同士の類似度を行列演算でまとめて計算しておく。
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    # 選択済みの候補との類似度の最大値を候補ごとに保持し、選ぶたびに1列分ずつ更新する。
+    max_similarity = np.full(len(candidates), -np.inf, dtype=np.float32)
+    selected_mask = np.zeros(len(candidates), dtype=bool)
+
+    # 1件目は質問との類似度が最も高い候補を選ぶ。
+    selected = [int(np.argmax(relevance))]
+    selected_mask[selected[0]] = True
+    while len(selected) < top_n:
+        max_similarity = np.maximum(max_similarity, similarity[:, selected[-1]])
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected_mask] = -np.inf
+        index = int(np.argmax(scores))
+        selected.append(index)
+        selected_mask[index] = True
+
+    return selected
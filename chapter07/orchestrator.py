@@ -1,106 +1,27 @@
 import os
-from azure.search.documents import SearchClient
-from openai import AzureOpenAI
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents.models import VectorizedQuery
+import requests
 import streamlit as st
 from dotenv import load_dotenv
 
 # .envファイルから環境変数を読み込む。
 load_dotenv(verbose=True)
 
-# 環境変数から各種Azureリソースへの接続情報を取得する。
-SEARCH_SERVICE_ENDPOINT = os.environ.get("SEARCH_SERVICE_ENDPOINT") # Azure AI Searchのエンドポイント
-SEARCH_SERVICE_API_KEY = os.environ.get("SEARCH_SERVICE_API_KEY") # Azure AI SearchのAPIキー
-SEARCH_SERVICE_INDEX_NAME = os.environ.get("SEARCH_SERVICE_INDEX_NAME") # Azure AI Searchのインデックス名
-AOAI_ENDPOINT = os.environ.get("AOAI_ENDPOINT") # Azure OpenAI Serviceのエンドポイント
-AOAI_API_VERSION = os.environ.get("AOAI_API_VERSION") # Azure OpenAI ServiceのAPIバージョン
-AOAI_API_KEY = os.environ.get("AOAI_API_KEY") # Azure OpenAI ServiceのAPIキー
-AOAI_EMBEDDING_MODEL_NAME = os.environ.get("AOAI_EMBEDDING_MODEL_NAME") # Azure OpenAI Serviceの埋め込みモデル名
-AOAI_CHAT_MODEL_NAME = os.environ.get("AOAI_CHAT_MODEL_NAME") # Azure OpenAI Serviceのチャットモデル名
-
-# AIのキャラクターを決めるためのシステムメッセージを定義する。
-system_message_chat_conversation = """
-あなたはユーザーの質問に回答するチャットボットです。
-回答については、「Sources:」以下に記載されている内容に基づいて回答してください。回答は簡潔にしてください。
-「Sources:」に記載されている情報以外の回答はしないでください。
-情報が複数ある場合は「Sources:」のあとに[Source1]、[Source2]、[Source3]のように記載されますので、それに基づいて回答してください。
-また、ユーザーの質問に対して、Sources:以下に記載されている内容に基づいて適切な回答ができない場合は、「すみません。わかりません。」と回答してください。
-回答の中に情報源の提示は含めないでください。例えば、回答の中に「[Source1]」や「Sources:」という形で情報源を示すことはしないでください。
-"""
+# 環境変数からRAGのAPIサーバー(api_server.py)のURLを取得する。
+RAG_API_URL = os.environ.get("RAG_API_URL", "http://127.0.0.1:8000") # RAGのAPIサーバーのURL
 
 # ユーザーの質問に対して回答を生成するための関数を定義する。
 # 引数はチャット履歴を表すJSON配列とする。
+# 検索と回答生成はAPIサーバーのRAGのエンジン(rag_engine.py)が行い、この画面はその結果を表示するだけにする。
 def search(history):
-    # [{'role': 'user', 'content': '有給は何日取れますか？'},{'role': 'assistant', 'content': '10日です'},
-    # {'role': 'user', 'content': '一日の労働上限時間は？'}...]というJSON配列から
-    # 最も末尾に格納されているJSONオブジェクトのcontent(=ユーザーの質問)を取得する。
-    question = history[-1].get('content')
-
-    # Azure AI SearchのAPIに接続するためのクライアントを生成する
-    search_client = SearchClient(
-        endpoint=SEARCH_SERVICE_ENDPOINT,
-        index_name=SEARCH_SERVICE_INDEX_NAME,
-        credential=AzureKeyCredential(SEARCH_SERVICE_API_KEY)
-    )
-
-    # Azure OpenAI ServiceのAPIに接続するためのクライアントを生成する
-    openai_client = AzureOpenAI(
-        azure_endpoint=AOAI_ENDPOINT,
-        api_key=AOAI_API_KEY,
-        api_version=AOAI_API_VERSION
-    )
-
-    # Azure OpenAI Serviceの埋め込み用APIを用いて、ユーザーからの質問をベクトル化する。
-    response = openai_client.embeddings.create(
-        input = question,
-        model = AOAI_EMBEDDING_MODEL_NAME
-    )
-
-    # ベクトル化された質問をAzure AI Searchに対して検索するためのクエリを生成する。
-    vector_query = VectorizedQuery(
-        vector=response.data[0].embedding,
-        k_nearest_neighbors=3,
-        # fields="contentVector"
-        # contextと間違えたので書き換える。
-        fields="contextVector"
-    )
-
-    # ベクトル化された質問を用いて、Azure AI Searchに対してベクトル検索を行う。
-    results = search_client.search(
-        vector_queries=[vector_query],
-        select=['id', 'content'])
-
-    # チャット履歴の中からユーザーの質問に対する回答を生成するためのメッセージを生成する。
-    messages = []
-
-    # 先頭にAIのキャラ付けを行うシステムメッセージを追加する。
-    messages.insert(0, {"role": "system", "content": system_message_chat_conversation})
-
-    # 回答を生成するためにAzure AI Searchから取得した情報を整形する。
-    sources = ["[Source" + result["id"] + "]: " + result["content"] for result in results]
-    source = "\n".join(sources)
-
-    # ユーザーの質問と情報源を含むメッセージを生成する。
-    user_message = """
-    {query}
-
-    Sources:
-    {source}
-    """.format(query=question, source=source)
-
-    # メッセージを追加する。
-    messages.append({"role": "user", "content": user_message})
+    response = requests.post(f"{RAG_API_URL}/search", json={"history": history}, timeout=120)
 
-    # Azure OpenAI Serviceに回答生成を依頼する。
-    response = openai_client.chat.completions.create(
-        model=AOAI_CHAT_MODEL_NAME,
-        messages=messages
-    )
-    answer = response.choices[0].message.content
+    # APIサーバーが混み合っている場合は、その旨を回答として返す。
+    if response.status_code == 503:
+        return "ただいま混み合っています。しばらくしてから再度お試しください。"
+    response.raise_for_status()
 
     # 回答を返す。
-    return answer
+    return response.json()["answer"]
 
 # ここからは画面を構築するためのコード
 # チャット履歴を初期化する。
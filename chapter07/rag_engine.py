@@ -0,0 +1,329 @@
+import os
+import asyncio
+from openai import AsyncAzureOpenAI
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizedQuery
+from dotenv import load_dotenv
+from context_builder import build_context
+from mmr import maximal_marginal_relevance
+from vector_store import QuantizedVectorStore
+from hedging import Deadline, LatencyTracker, hedged
+
+# .envファイルから環境変数を読み込む。
+load_dotenv(verbose=True)
+
+# 環境変数から各種Azureリソースへの接続情報を取得する。
+SEARCH_SERVICE_ENDPOINT = os.environ.get("SEARCH_SERVICE_ENDPOINT") # Azure AI Searchのエンドポイント
+SEARCH_SERVICE_API_KEY = os.environ.get("SEARCH_SERVICE_API_KEY") # Azure AI SearchのAPIキー
+SEARCH_SERVICE_INDEX_NAME = os.environ.get("SEARCH_SERVICE_INDEX_NAME") # Azure AI Searchのインデックス名
+AOAI_ENDPOINT = os.environ.get("AOAI_ENDPOINT") # Azure OpenAI Serviceのエンドポイント
+AOAI_API_VERSION = os.environ.get("AOAI_API_VERSION") # Azure OpenAI ServiceのAPIバージョン
+AOAI_API_KEY = os.environ.get("AOAI_API_KEY") # Azure OpenAI ServiceのAPIキー
+AOAI_EMBEDDING_MODEL_NAME = os.environ.get("AOAI_EMBEDDING_MODEL_NAME") # Azure OpenAI Serviceの埋め込みモデル名
+AOAI_CHAT_MODEL_NAME = os.environ.get("AOAI_CHAT_MODEL_NAME") # Azure OpenAI Serviceのチャットモデル名
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500")) # プロンプトに埋め込む情報源のトークン数の上限
+MMR_CANDIDATES = int(os.environ.get("MMR_CANDIDATES", "20")) # MMRで多様性を考慮する前に取得する候補の件数
+MMR_TOP_N = int(os.environ.get("MMR_TOP_N", "3")) # MMRで最終的に選ぶ情報源の件数
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", "0.5")) # MMRの関連度の重み(1に近いほど関連度、0に近いほど多様性を重視する)
+VECTOR_STORE_DIR = os.environ.get("VECTOR_STORE_DIR") # vector_store.pyで作成したベクトルストアの保存先(MMRの候補のベクトルをここから読み込む)
+MMR_FETCH_VECTORS = os.environ.get("MMR_FETCH_VECTORS", "false").lower() == "true" # ベクトルストアがない場合も、検索結果からベクトルを取得してMMRを行うか
+EMBEDDING_BATCH_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_WAIT_MS", "5")) # 埋め込みのリクエストをまとめるために待つ時間(ミリ秒)
+EMBEDDING_MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", "16")) # 1回の埋め込みのリクエストにまとめる最大の件数
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "vector") # 検索方法(vector: ベクトル検索、hybrid: ハイブリッド検索、local: ベクトルストアで候補を検索)
+LOCAL_RESCORE_MULTIPLIER = int(os.environ.get("LOCAL_RESCORE_MULTIPLIER", "4")) # localの場合に、量子化済みのコードで絞り込む候補の倍率
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", "30")) # 1つの質問に回答するまでの締め切り(秒)
+RETRIEVAL_BUDGET_RATIO = float(os.environ.get("RETRIEVAL_BUDGET_RATIO", "0.3")) # 締め切りまでの時間のうち、検索に割り当てる割合
+KEYWORD_FALLBACK_TIMEOUT_SECONDS = float(os.environ.get("KEYWORD_FALLBACK_TIMEOUT_SECONDS", "2")) # キーワード検索に切り替えた場合の検索の締め切りの上限(秒)
+KEYWORD_FALLBACK_RATIO = float(os.environ.get("KEYWORD_FALLBACK_RATIO", "0.3")) # キーワード検索に切り替えた場合に、締め切りまでの残り時間のうち割り当てる割合
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95")) # この処理時間のパーセンタイル値を過ぎたらバックアップのリクエストを送る
+HEDGE_DEFAULT_DELAY_MS = float(os.environ.get("HEDGE_DEFAULT_DELAY_MS", "500")) # 処理時間の記録が少ないうちに使うバックアップまでの待ち時間(ミリ秒)
+
+# ベクトルを格納しているフィールド名
+VECTOR_FIELD_NAME = "contextVector"
+
+# AIのキャラクターを決めるためのシステムメッセージを定義する。
+system_message_chat_conversation = """
+あなたはユーザーの質問に回答するチャットボットです。
+回答については、「Sources:」以下に記載されている内容に基づいて回答してください。回答は簡潔にしてください。
+「Sources:」に記載されている情報以外の回答はしないでください。
+情報が複数ある場合は「Sources:」のあとに[Source1]、[Source2]、[Source3]のように記載されますので、それに基づいて回答してください。
+また、ユーザーの質問に対して、Sources:以下に記載されている内容に基づいて適切な回答ができない場合は、「すみません。わかりません。」と回答してください。
+回答の中に情報源の提示は含めないでください。例えば、回答の中に「[Source1]」や「Sources:」という形で情報源を示すことはしないでください。
+"""
+
+# 短い時間のうちに届いた埋め込みのリクエストを、1回のAPI呼び出しにまとめるクラスを定義する。
+# 最初のリクエストが届いてからmax_wait_msミリ秒待つか、max_batch_size件たまった時点でまとめて送信する。
+class EmbeddingBatcher:
+    def __init__(self, openai_client: AsyncAzureOpenAI, model: str,
+                 max_wait_ms: float = EMBEDDING_BATCH_WAIT_MS, max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE):
+        self.openai_client = openai_client
+        self.model = model
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.queue = asyncio.Queue()
+        self.worker = None
+        self.pending = set()  # 送信中のタスク(ガベージコレクションで消えないように参照を持っておく)
+
+    # テキストを1件ベクトル化する。実際の送信は、ほかのリクエストとまとめて行われる。
+    async def embed(self, text: str):
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.collect())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    # キューからリクエストを取り出して、バッチにまとめ続ける。
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # 送信を待たずに次のバッチを集め始められるよう、送信は別のタスクで行う。
+            task = asyncio.create_task(self.flush(batch))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+
+    # まとめたリクエストを1回のAPI呼び出しで送信し、結果をそれぞれの呼び出し元に返す。
+    async def flush(self, batch: list):
+        # 呼び出し元が既に待つのをやめたリクエストは送信しない。
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            return
+        try:
+            response = await self.openai_client.embeddings.create(
+                input = [text for text, _ in batch],
+                model = self.model
+            )
+            for data in response.data:
+                future = batch[data.index][1]
+                if not future.done():
+                    future.set_result(data.embedding)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+# 締め切りまでに回答を生成できなかった場合の回答
+timeout_answer = "すみません。時間内に回答を生成できませんでした。"
+
+# 検索と回答生成を行うRAGのエンジンを定義する。
+# Streamlitの画面やAPIサーバー、評価データの生成スクリプトなど、どこからでも同じ処理を呼び出せるようにする。
+class RagEngine:
+    def __init__(self):
+        # Azure AI SearchのAPIに接続するためのクライアントを生成する
+        self.search_client = SearchClient(
+            endpoint=SEARCH_SERVICE_ENDPOINT,
+            index_name=SEARCH_SERVICE_INDEX_NAME,
+            credential=AzureKeyCredential(SEARCH_SERVICE_API_KEY)
+        )
+
+        # Azure OpenAI ServiceのAPIに接続するためのクライアントを生成する
+        self.openai_client = AsyncAzureOpenAI(
+            azure_endpoint=AOAI_ENDPOINT,
+            api_key=AOAI_API_KEY,
+            api_version=AOAI_API_VERSION
+        )
+
+        self.embedding_batcher = EmbeddingBatcher(self.openai_client, AOAI_EMBEDDING_MODEL_NAME)
+        self.vector_store = QuantizedVectorStore(VECTOR_STORE_DIR) if VECTOR_STORE_DIR else None
+
+        # MMRは、候補のベクトルを手元のベクトルストアから読み込める場合にだけ既定で行う。
+        # ベクトルストアがない場合は検索結果にベクトルを含める必要があり、MMR_CANDIDATES件×次元数の数値が
+        # JSONで返される(1536次元・20件で1リクエストあたり数百KB)ため、応答が遅くなる。
+        # その分の遅延を許容する場合だけ、MMR_FETCH_VECTORSをtrueにして有効にする。
+        self.use_mmr = self.vector_store is not None or MMR_FETCH_VECTORS
+
+        # ヘッジの待ち時間を決めるため、埋め込みと検索の処理時間をそれぞれ記録する。
+        # 検索は種類によって処理時間が大きく異なるため、ベクトル検索(ハイブリッド検索を含む)、
+        # キーワード検索、idを指定した本文の取得を別々に記録する。
+        # (まとめて記録すると、軽い検索に引きずられてベクトル検索を早すぎるタイミングでヘッジしてしまう)
+        self.embedding_latency = LatencyTracker(HEDGE_DEFAULT_DELAY_MS / 1000)
+        self.vector_search_latency = LatencyTracker(HEDGE_DEFAULT_DELAY_MS / 1000)
+        self.keyword_search_latency = LatencyTracker(HEDGE_DEFAULT_DELAY_MS / 1000)
+        self.lookup_latency = LatencyTracker(HEDGE_DEFAULT_DELAY_MS / 1000)
+
+    # Azure AI Searchに対して検索を行い、検索結果をリストにして返す。
+    async def run_search(self, **kwargs):
+        results = await self.search_client.search(**kwargs)
+        return [result async for result in results]
+
+    # 質問文だけを使ってキーワード検索を行う。
+    # 埋め込みやベクトル検索が締め切りに間に合わない場合の代わりとして使う。
+    async def keyword_search(self, question: str, timeout: float):
+        results = await hedged(
+            lambda: self.run_search(search_text=question, select=['id', 'content'], top=MMR_TOP_N),
+            self.keyword_search_latency, HEDGE_PERCENTILE, timeout
+        )
+        return results
+
+    # ベクトルストアを使って、質問に近いチャンクの候補を検索する。
+    # 量子化済みのコードで候補を絞り込み、メモリマップした元の精度のベクトルで並べ直す。
+    # ベクトルストアには本文がないため、本文だけをidを指定してAzure AI Searchから取得する(ベクトル検索は行わない)。
+    async def local_search(self, question_vector, timeout: float):
+        candidates = await asyncio.to_thread(
+            self.vector_store.search, question_vector, MMR_CANDIDATES, LOCAL_RESCORE_MULTIPLIER
+        )
+        ids = [doc_id for doc_id, _ in candidates]
+        if not ids:
+            return []
+
+        found = await hedged(
+            lambda: self.run_search(
+                search_text="*",
+                filter="search.in(id, '{ids}', ',')".format(ids=",".join(ids)),
+                select=['id', 'content'],
+                top=len(ids)),
+            self.lookup_latency, HEDGE_PERCENTILE, timeout
+        )
+        # ベクトルストアで並べ直した順に並べる。
+        by_id = {result["id"]: result for result in found}
+        return [by_id[doc_id] for doc_id in ids if doc_id in by_id]
+
+    # 質問に関連するチャンクを検索し、MMRで多様性のある上位のチャンクを選ぶ。
+    # overall_deadlineはリクエスト全体の締め切りとし、そのうちRETRIEVAL_BUDGET_RATIOの割合を検索に使う。
+    # 締め切りに間に合わない段階があった場合は、キーワード検索に切り替えてdegradedに記録する。
+    # キーワード検索の締め切りは、KEYWORD_FALLBACK_TIMEOUT_SECONDSと全体の残り時間のKEYWORD_FALLBACK_RATIOの短い方とし、
+    # 回答生成に使う時間を食いつぶさないようにする。
+    async def retrieve(self, question: str, overall_deadline: Deadline, degraded: list):
+        deadline = overall_deadline.split(RETRIEVAL_BUDGET_RATIO)
+        def fallback_timeout():
+            return min(KEYWORD_FALLBACK_TIMEOUT_SECONDS, overall_deadline.remaining() * KEYWORD_FALLBACK_RATIO)
+
+        # Azure OpenAI Serviceの埋め込み用APIを用いて、ユーザーからの質問をベクトル化する。
+        # 遅い場合に備えてヘッジ付きで呼び出す。
+        try:
+            question_vector = await hedged(
+                lambda: self.embedding_batcher.embed(question),
+                self.embedding_latency, HEDGE_PERCENTILE, deadline.remaining()
+            )
+        except asyncio.TimeoutError:
+            degraded.append("embedding_timeout")
+            return await self.keyword_search(question, fallback_timeout())
+
+        # ベクトル化された質問をAzure AI Searchに対して検索するためのクエリを生成する。
+        # MMRを行う場合は、似通ったチャンクばかりにならないよう、多めに候補を取得してからMMRで絞り込む。
+        # MMRを行わない場合は、上位MMR_TOP_N件だけを取得する。
+        candidates = MMR_CANDIDATES if self.use_mmr else MMR_TOP_N
+        vector_query = VectorizedQuery(
+            vector=question_vector,
+            k_nearest_neighbors=candidates,
+            fields=VECTOR_FIELD_NAME
+        )
+
+        # ベクトル化された質問を用いて、Azure AI Searchに対してベクトル検索(またはハイブリッド検索)を行う。
+        # RETRIEVAL_MODEがlocalでベクトルストアがある場合は、候補の検索をベクトルストアで行う。
+        # 検索結果にベクトルを含めるのは、ベクトルストアがなくMMRを行う場合だけとする。
+        select = ['id', 'content', VECTOR_FIELD_NAME] if self.use_mmr and not self.vector_store else ['id', 'content']
+        search_text = question if RETRIEVAL_MODE == "hybrid" else None
+        try:
+            if RETRIEVAL_MODE == "local" and self.vector_store:
+                results = await self.local_search(question_vector, deadline.remaining())
+            else:
+                results = await hedged(
+                    lambda: self.run_search(
+                        search_text=search_text,
+                        vector_queries=[vector_query],
+                        select=select,
+                        top=candidates),
+                    self.vector_search_latency, HEDGE_PERCENTILE, deadline.remaining()
+                )
+        except asyncio.TimeoutError:
+            degraded.append("search_timeout")
+            return await self.keyword_search(question, fallback_timeout())
+
+        # 候補の中から、質問との関連度が高く、かつ互いに似ていないチャンクを選ぶ。
+        # ベクトルストアに登録されていない候補がある場合は、MMRを行わずに検索順位の上位をそのまま使う。
+        if results and self.vector_store:
+            missing = self.vector_store.missing_ids([result["id"] for result in results])
+            if missing:
+                print(f"ベクトルストアに登録されていないため、MMRを行いません: id={', '.join(missing)}")
+                degraded.append("vector_store_missing_ids")
+                return results[:MMR_TOP_N]
+
+        if results and self.use_mmr:
+            if self.vector_store:
+                candidate_vectors = self.vector_store.get_vectors([result["id"] for result in results])
+            else:
+                candidate_vectors = [result[VECTOR_FIELD_NAME] for result in results]
+            selected = maximal_marginal_relevance(
+                question_vector,
+                candidate_vectors,
+                top_n=MMR_TOP_N,
+                lambda_mult=MMR_LAMBDA
+            )
+            results = [results[i] for i in selected]
+
+        return results
+
+    # 情報源をもとに、Azure OpenAI Serviceに回答の生成を依頼する。
+    async def generate(self, question: str, sources: list):
+        # 先頭にAIのキャラ付けを行うシステムメッセージを追加する。
+        messages = [{"role": "system", "content": system_message_chat_conversation}]
+
+        # ユーザーの質問と情報源を含むメッセージを生成する。
+        user_message = """
+        {query}
+
+        Sources:
+        {source}
+        """.format(query=question, source="\n".join(sources))
+        messages.append({"role": "user", "content": user_message})
+
+        response = await self.openai_client.chat.completions.create(
+            model=AOAI_CHAT_MODEL_NAME,
+            messages=messages
+        )
+        return response.choices[0].message.content
+
+    # ユーザーの質問に対して回答を生成する。
+    # 引数はチャット履歴を表すJSON配列とし、最も末尾に格納されている質問に回答する。
+    # timeoutは回答までの締め切り(秒)とし、検索と回答生成に割り振る。
+    # 戻り値は回答、情報源のリスト、情報源のトークン数などの統計情報、
+    # 締め切りに間に合わない場合などに通常の処理から切り替えた処理の一覧(degraded)を持つ辞書とする。
+    async def answer(self, history: list, timeout: float = None):
+        question = history[-1].get('content')
+        deadline = Deadline(timeout or REQUEST_TIMEOUT_SECONDS)
+        degraded = []
+
+        # 締め切りまでの時間のうち、RETRIEVAL_BUDGET_RATIOの割合を検索に割り当てる。
+        # キーワード検索でも間に合わない場合は、情報源なしで回答生成に進む。
+        try:
+            results = await self.retrieve(question, deadline, degraded)
+        except asyncio.TimeoutError:
+            degraded.append("keyword_search_timeout")
+            results = []
+
+        # 隣り合うチャンクの重なりを取り除き、トークン数の予算内に収まるように詰め込む。
+        sources, stats = build_context(results, CONTEXT_TOKEN_BUDGET)
+        print(f"情報源のトークン数: {stats['context_tokens']} (重なりの除去で削減: {stats['overlap_saved_tokens']}トークン / "
+              f"予算で削除: {stats['budget_dropped_tokens']}トークン / 予算: {CONTEXT_TOKEN_BUDGET})")
+
+        # 残りの時間をすべて回答生成に割り当てる。
+        try:
+            answer = await asyncio.wait_for(self.generate(question, sources), deadline.remaining())
+        except asyncio.TimeoutError:
+            degraded.append("generation_timeout")
+            answer = timeout_answer
+
+        if degraded:
+            print(f"通常の処理から切り替えた処理: {', '.join(degraded)}")
+        return {"answer": answer, "sources": sources, "stats": stats, "degraded": degraded}
+
+    async def close(self):
+        await self.embedding_batcher.close()
+        await self.search_client.close()
+        await self.openai_client.close()
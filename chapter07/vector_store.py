@@ -0,0 +1,285 @@
+import os
+import sys
+import csv
+import json
+import time
+import numpy as np
+from azure.search.documents import SearchClient
+from openai import AzureOpenAI
+from azure.core.credentials import AzureKeyCredential
+from dotenv import load_dotenv
+from chunk_store import ChunkStore
+
+# .envファイルから環境変数を読み込む。
+load_dotenv(verbose=True)
+
+# 環境変数から各種Azureリソースへの接続情報を取得する。
+SEARCH_SERVICE_ENDPOINT = os.environ.get("SEARCH_SERVICE_ENDPOINT") # Azure AI Searchのエンドポイント
+SEARCH_SERVICE_API_KEY = os.environ.get("SEARCH_SERVICE_API_KEY") # Azure AI SearchのAPIキー
+SEARCH_SERVICE_INDEX_NAME = os.environ.get("SEARCH_SERVICE_INDEX_NAME") # Azure AI Searchのインデックス名
+AOAI_ENDPOINT = os.environ.get("AOAI_ENDPOINT") # Azure OpenAI Serviceのエンドポイント
+AOAI_API_VERSION = os.environ.get("AOAI_API_VERSION") # Azure OpenAI ServiceのAPIバージョン
+AOAI_API_KEY = os.environ.get("AOAI_API_KEY") # Azure OpenAI ServiceのAPIキー
+AOAI_EMBEDDING_MODEL_NAME = os.environ.get("AOAI_EMBEDDING_MODEL_NAME") # Azure OpenAI Serviceの埋め込みモデル名
+
+# ベクトルを格納しているフィールド名
+VECTOR_FIELD_NAME = "contextVector"
+
+# ベクトルストアを構成するファイル名
+META_FILE = "meta.json"  # 件数・次元数・量子化方式などの設定
+IDS_FILE = "ids.json"  # 行番号とドキュメントのidの対応
+VECTORS_FILE = "vectors.f32"  # 再スコアリング用の元の精度(float32)のベクトル。メモリマップで読み込む。
+CODES_FILE = "codes.npy"  # 1段目の検索に使う量子化済みのコード
+SCALE_FILE = "scale.npy"  # int8量子化の次元ごとの刻み幅
+OFFSET_FILE = "offset.npy"  # int8量子化の次元ごとの最小値
+
+# 一度に処理する行数（大きなコーパスでもメモリを使いすぎないようにブロック単位で処理する）
+BLOCK_SIZE = 65536
+
+# 0〜255の各値に立っているビットの数の表（バイナリ量子化のハミング距離の計算に使う）
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# ベクトルを長さ1に正規化する関数を定義する。
+def normalize(vectors: np.ndarray):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+# 先頭のdims次元だけを残して、長さ1に正規化し直す関数を定義する。
+# text-embedding-3系のモデルは、先頭の次元ほど重要な情報を持つように学習されている。
+def truncate(vectors: np.ndarray, dims: int):
+    return normalize(np.asarray(vectors, dtype=np.float32)[..., :dims])
+
+# ベクトルの行列を量子化する関数を定義する。
+# int8では次元ごとに最小値と最大値の間を256段階に、binaryでは符号だけを1ビットで表す。
+def quantize(vectors: np.ndarray, quantization: str, scale=None, offset=None):
+    if quantization == "int8":
+        levels = np.round((vectors - offset) / scale) - 128
+        return np.clip(levels, -128, 127).astype(np.int8)
+    elif quantization == "binary":
+        return np.packbits(vectors > 0, axis=-1)
+    raise ValueError(f"未対応の量子化方式です: {quantization}")
+
+# 量子化されたベクトルストアを表すクラスを定義する。
+# 量子化済みのコードだけをメモリに載せて1段目の検索を行い、
+# 絞り込んだ候補だけをメモリマップしたfloat32のベクトルで正確に再スコアリングする。
+class QuantizedVectorStore:
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, IDS_FILE), encoding="utf-8") as f:
+            self.ids = json.load(f)
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+
+        self.quantization = self.meta["quantization"]
+        self.dims = self.meta["dims"]
+        self.truncate_dims = self.meta["truncate_dims"]
+        self.vectors = np.memmap(
+            os.path.join(path, VECTORS_FILE), dtype=np.float32, mode="r",
+            shape=(len(self.ids), self.dims)
+        )
+        self.codes = np.load(os.path.join(path, CODES_FILE))
+        if self.quantization == "int8":
+            self.scale = np.load(os.path.join(path, SCALE_FILE))
+            self.offset = np.load(os.path.join(path, OFFSET_FILE))
+
+    def __len__(self):
+        return len(self.ids)
+
+    # 量子化済みのコードを使って、質問との近さを全件についてざっくり計算する。
+    def approximate_scores(self, query_vector):
+        query = truncate(query_vector, self.truncate_dims)
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        if self.quantization == "int8":
+            # q・(code×scale + offset) = (q×scale)・code + q・offset と分解して計算する。
+            scaled_query = query * self.scale
+            bias = float(query @ (self.offset + 128 * self.scale))
+            for start in range(0, len(self.ids), BLOCK_SIZE):
+                block = self.codes[start:start + BLOCK_SIZE].astype(np.float32)
+                scores[start:start + BLOCK_SIZE] = block @ scaled_query + bias
+        else:
+            # ハミング距離が小さいほど近いので、符号を反転させてスコアにする。
+            query_code = np.packbits(query > 0)
+            for start in range(0, len(self.ids), BLOCK_SIZE):
+                distance = POPCOUNT_TABLE[np.bitwise_xor(self.codes[start:start + BLOCK_SIZE], query_code)].sum(axis=1, dtype=np.int32)
+                scores[start:start + BLOCK_SIZE] = -distance
+        return scores
+
+    # 質問に近いベクトルを上位k件検索する。
+    # 1段目でk×rescore_multiplier件の候補に絞り込み、2段目で元の精度のベクトルを使って並べ直す。
+    def search(self, query_vector, k: int = 3, rescore_multiplier: int = 4):
+        k = min(k, len(self.ids))
+        if k <= 0:
+            return []
+        scores = self.approximate_scores(query_vector)
+        candidate_count = min(len(self.ids), k * rescore_multiplier)
+        candidates = np.argpartition(-scores, candidate_count - 1)[:candidate_count]
+        candidates.sort()
+
+        query = normalize(np.asarray(query_vector, dtype=np.float32))
+        exact_scores = self.vectors[candidates] @ query
+        order = np.argsort(-exact_scores)[:k]
+        return [(self.ids[candidates[i]], float(exact_scores[i])) for i in order]
+
+    # 指定したidのうち、ベクトルストアに登録されていないものを返す。
+    # インデックスを作り直した後にベクトルストアを作り直していない場合などに発生する。
+    def missing_ids(self, ids: list):
+        return [str(doc_id) for doc_id in ids if str(doc_id) not in self.rows]
+
+    # 指定したidのベクトルを、元の精度でメモリマップから読み込む。
+    # 登録されていないidが含まれる場合はKeyErrorになるため、先にmissing_idsで確認しておく。
+    def get_vectors(self, ids: list):
+        rows = [self.rows[str(doc_id)] for doc_id in ids]
+        return np.asarray(self.vectors[rows])
+
+    # 元の精度のベクトルと量子化済みのコードのメモリ使用量(バイト数)を返す。
+    def memory_usage(self):
+        return {"full_precision": int(self.vectors.nbytes), "quantized": int(self.codes.nbytes)}
+
+# ベクトルストアをファイルに書き出す関数を定義する。
+# vector_batchesは(idのリスト, ベクトルのリスト)の組を順に返すイテレータとする。
+def build_store(path: str, vector_batches, quantization: str = "int8", truncate_dims: int = None):
+    os.makedirs(path, exist_ok=True)
+
+    # 元の精度のベクトルを、正規化してからfloat32のままファイルに追記していく。
+    ids = []
+    dims = None
+    with open(os.path.join(path, VECTORS_FILE), "wb") as f:
+        for batch_ids, batch_vectors in vector_batches:
+            vectors = normalize(np.asarray(batch_vectors, dtype=np.float32))
+            dims = vectors.shape[1]
+            f.write(vectors.tobytes())
+            ids.extend(str(doc_id) for doc_id in batch_ids)
+
+    if dims is None:
+        raise ValueError("ベクトルが1件もありません")
+    truncate_dims = min(truncate_dims or dims, dims)
+    vectors = np.memmap(os.path.join(path, VECTORS_FILE), dtype=np.float32, mode="r", shape=(len(ids), dims))
+
+    # int8量子化では、次元ごとの最小値と最大値から刻み幅を決める。
+    scale = offset = None
+    if quantization == "int8":
+        minimum = np.full(truncate_dims, np.inf, dtype=np.float32)
+        maximum = np.full(truncate_dims, -np.inf, dtype=np.float32)
+        for start in range(0, len(ids), BLOCK_SIZE):
+            block = truncate(vectors[start:start + BLOCK_SIZE], truncate_dims)
+            minimum = np.minimum(minimum, block.min(axis=0))
+            maximum = np.maximum(maximum, block.max(axis=0))
+        offset = minimum
+        scale = np.maximum(maximum - minimum, 1e-12) / 255
+        np.save(os.path.join(path, SCALE_FILE), scale.astype(np.float32))
+        np.save(os.path.join(path, OFFSET_FILE), offset.astype(np.float32))
+
+    # 量子化済みのコードをブロックごとに計算して保存する。
+    codes = np.concatenate([
+        quantize(truncate(vectors[start:start + BLOCK_SIZE], truncate_dims), quantization, scale, offset)
+        for start in range(0, len(ids), BLOCK_SIZE)
+    ])
+    np.save(os.path.join(path, CODES_FILE), codes)
+
+    with open(os.path.join(path, IDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    with open(os.path.join(path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"quantization": quantization, "dims": dims, "truncate_dims": truncate_dims}, f)
+
+    return QuantizedVectorStore(path)
+
+# Azure AI Searchに登録されているベクトルを、ページ単位で取得する関数を定義する。
+def fetch_vectors_from_index(batch_size: int = 1000):
+    search_client = SearchClient(
+        endpoint=SEARCH_SERVICE_ENDPOINT,
+        index_name=SEARCH_SERVICE_INDEX_NAME,
+        credential=AzureKeyCredential(SEARCH_SERVICE_API_KEY)
+    )
+    results = search_client.search(search_text="*", select=["id", VECTOR_FIELD_NAME])
+
+    ids, vectors = [], []
+    for result in results:
+        ids.append(result["id"])
+        vectors.append(result[VECTOR_FIELD_NAME])
+        if len(ids) == batch_size:
+            yield ids, vectors
+            ids, vectors = [], []
+    if ids:
+        yield ids, vectors
+
+# 評価用の質問をCSVファイルから読み込み、ベクトル化する関数を定義する。
+# CSVファイルはgenerate_eval_data.pyと同じく、question列を持つものとする。
+def embed_questions(file_path: str):
+    openai_client = AzureOpenAI(
+        azure_endpoint=AOAI_ENDPOINT,
+        api_key=AOAI_API_KEY,
+        api_version=AOAI_API_VERSION
+    )
+    with open(file_path, mode='r', encoding='utf-8') as file:
+        questions = [row['question'] for row in csv.DictReader(file)]
+
+    response = openai_client.embeddings.create(
+        input = questions,
+        model = AOAI_EMBEDDING_MODEL_NAME
+    )
+    return np.asarray([data.embedding for data in response.data], dtype=np.float32)
+
+# 量子化によるメモリ削減量と、正確な検索結果と比べた再現率(recall@k)を計測する関数を定義する。
+def report(store: QuantizedVectorStore, queries: np.ndarray, k: int = 3, rescore_multiplier: int = 4):
+    queries = normalize(np.asarray(queries, dtype=np.float32))
+
+    recalls, latencies = [], []
+    for query in queries:
+        # 元の精度のベクトルを全件調べた場合の正解の上位k件
+        exact_scores = np.concatenate([
+            np.asarray(store.vectors[start:start + BLOCK_SIZE]) @ query
+            for start in range(0, len(store), BLOCK_SIZE)
+        ])
+        exact = {store.ids[i] for i in np.argsort(-exact_scores)[:k]}
+
+        start = time.perf_counter()
+        found = {doc_id for doc_id, _ in store.search(query, k, rescore_multiplier)}
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len(found & exact) / len(exact))
+
+    usage = store.memory_usage()
+    return {
+        "documents": len(store),
+        "quantization": store.quantization,
+        "truncate_dims": store.truncate_dims,
+        "full_precision_bytes": usage["full_precision"],
+        "quantized_bytes": usage["quantized"],
+        "compression_ratio": usage["full_precision"] / max(usage["quantized"], 1),
+        f"recall@{k}": float(np.mean(recalls)),
+        "recall_loss": 1 - float(np.mean(recalls)),
+        "mean_latency_ms": float(np.mean(latencies) * 1000)
+    }
+
+if __name__ == "__main__":
+    # 使い方:
+    #   python vector_store.py build <保存先> [int8|binary] [切り詰める次元数]
+    #   python vector_store.py build-chunks <保存先> <チャンクストア> [int8|binary] [切り詰める次元数]
+    #   python vector_store.py report <保存先> [評価用の質問のCSVファイル]
+    if len(sys.argv) < 3 or sys.argv[1] not in ("build", "build-chunks", "report"):
+        print("使い方: python vector_store.py build|build-chunks|report <保存先> ...")
+        sys.exit(1)
+
+    command, path = sys.argv[1], sys.argv[2]
+
+    if command == "build":
+        quantization = sys.argv[3] if len(sys.argv) > 3 else "int8"
+        truncate_dims = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        store = build_store(path, fetch_vectors_from_index(), quantization, truncate_dims)
+        print(f"{len(store)}件のベクトルを{path}に保存しました")
+    elif command == "build-chunks":
+        # インデクサーがチャンクストアに保存したベクトルから作成する(インデックスからダウンロードしない)。
+        quantization = sys.argv[4] if len(sys.argv) > 4 else "int8"
+        truncate_dims = int(sys.argv[5]) if len(sys.argv) > 5 else None
+        store = build_store(path, ChunkStore(sys.argv[3]).iter_embedding_batches(), quantization, truncate_dims)
+        print(f"{len(store)}件のベクトルを{path}に保存しました")
+    else:
+        store = QuantizedVectorStore(path)
+        if len(sys.argv) > 3:
+            queries = embed_questions(sys.argv[3])
+        else:
+            # 質問が指定されない場合は、登録済みのベクトルから100件を取り出して質問の代わりに使う。
+            rows = np.random.default_rng(0).choice(len(store), size=min(100, len(store)), replace=False)
+            queries = np.asarray(store.vectors[np.sort(rows)])
+        for key, value in report(store, queries).items():
+            print(f"{key}: {value}")
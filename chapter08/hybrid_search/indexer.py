@@ -1,11 +1,15 @@
 import os
+import sys
 import wikipedia
 from azure.core.credentials import AzureKeyCredential
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from azure.search.documents import SearchClient
 from openai import AzureOpenAI
 from dotenv import load_dotenv
-import uuid
+
+# chapter07のチャンクストアを使うため、chapter07のディレクトリをモジュールの検索パスに追加する。
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "chapter07"))
+from chunk_store import ChunkStore, ChunkStoreWriter
 
 # .envファイルから環境変数を読み込む。
 load_dotenv(verbose=True)
@@ -52,21 +56,28 @@ def create_chunk(title, chunk_size, chunk_overlap, output_dir='data', lang='ja')
     return chunks
 
 # チャンクをAzure AI Searchに登録する。
-def index_docs(title: str, chunk: str):
+# 引数はIDのリスト、タイトルのリスト、チャンクのリストとし、まとめてベクトル化する。
+# 戻り値はチャンクのベクトルのリストとする。
+def index_docs(ids: list, titles: list, chunks: list):
     # 引数によって渡されたチャンクのリストをベクトル化する。
     response = openAIClient.embeddings.create(
-        input = chunk,
+        input = chunks,
         model = AOAI_EMBEDDING_MODEL_NAME
     )
+    vectors = [data.embedding for data in response.data]
 
     # チャンクのテキストと、そのチャンクをベクトル化したものをAzure AI Searchに登録する。
-    document = {
-        "id": str(uuid.uuid4()), 
-        "title": title,
-        "content": chunk, 
-        "contentVector": response.data[0].embedding
-    }
-    searchClient.upload_documents([document])
+    documents = [
+        {
+            "id": doc_id, 
+            "title": title,
+            "content": chunk, 
+            "contentVector": vector
+        }
+        for doc_id, title, chunk, vector in zip(ids, titles, chunks, vectors)
+    ]
+    searchClient.upload_documents(documents)
+    return vectors
 
 characters = [
     "ウィリアム・シェイクスピア",
@@ -87,7 +98,33 @@ characters = [
 chunk_size = 1000  # チャンクサイズ
 chunk_overlap = 50  # チャンクのオーバーラップ
 
-for character in characters:
-    chunks = create_chunk(character, chunk_size, chunk_overlap)
-    for i, chunk in enumerate(chunks):
-        index_docs(f"{character}_{i:02}", chunk)
+chunk_store_dir = "chunks"  # チャンクストアの保存先
+
+# 各人物のページをチャンク化して、チャンクストアに保存する。
+with ChunkStoreWriter(chunk_store_dir) as writer:
+    for character in characters:
+        chunks = create_chunk(character, chunk_size, chunk_overlap)
+        for chunk in chunks:
+            writer.add(chunk, source=character)
+
+# チャンクストアから16件ずつ読み込んでAzure AI Searchに登録し、ベクトルはチャンクストアにも保存する。
+# ドキュメントのIDはチャンクストアでの位置とし、検索結果からチャンクストアの行を引けるようにする。
+# (chapter07のインデクサーと同じ付け方なので、vector_store.pyのbuild-chunksで作ったベクトルストアとも対応する)
+store = ChunkStore(chunk_store_dir)
+embeddings = None
+number = 0
+for start, chunks in store.iter_batches(16):
+    # タイトルは「人物名_ページ内の通し番号」とし、人物が変わったら番号を0に戻す。
+    titles = []
+    for i in range(start, start + len(chunks)):
+        number = number + 1 if i > 0 and store.source(i) == store.source(i - 1) else 0
+        titles.append(f"{store.source(i)}_{number:02}")
+
+    ids = [str(i) for i in range(start, start + len(chunks))]
+    vectors = index_docs(ids, titles, chunks)
+    if embeddings is None:
+        embeddings = store.create_embeddings(len(vectors[0]))
+    embeddings[start:start + len(vectors)] = vectors
+
+if embeddings is not None:
+    embeddings.flush()
@@ -2,6 +2,12 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter, MarkdownHead
 from langchain_experimental.text_splitter import SemanticChunker
 from langchain_openai import AzureOpenAIEmbeddings
 from dotenv import load_dotenv
+import os
+import sys
+
+# chapter07のチャンクストアを使うため、chapter07のディレクトリをモジュールの検索パスに追加する。
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "chapter07"))
+from chunk_store import ChunkStoreWriter
 
 # サンプルドキュメント（このテキストを各手法でチャンク化する）
 document = """
@@ -25,7 +31,7 @@ document = """
 """
 
 # 文字数ベースでのチャンク化を行う関数（ファイル出力版）
-def chunk_by_character(document, output_path="character_chunks.txt"):
+def chunk_by_character(document, output_path="character_chunks.txt", store_path="character_chunks"):
     # 複数の区切り文字（改行、句読点、スペースなど）を設定
     separators = ["\n\n", "\n", "。", "、", " ", ""]
     # RecursiveCharacterTextSplitterを使って文字数100ごとに分割
@@ -41,12 +47,16 @@ def chunk_by_character(document, output_path="character_chunks.txt"):
         for i, chunk in enumerate(chunks, start=1):
             f.write(f"=== Chunk {i} ===\n")
             f.write(chunk + "\n\n")
+    # チャンクストアにも書き出し(インデクサーなど後続の処理から読み込めるようにする)
+    with ChunkStoreWriter(store_path) as writer:
+        for chunk in chunks:
+            writer.add(chunk, source="character")
     # 完了メッセージを表示
-    print(f"Character-based chunks written to {output_path}")
+    print(f"Character-based chunks written to {output_path} and {store_path}")
 
 
 # Markdownヘッダーに基づいてチャンク化を行う関数（ファイル出力版）
-def chunk_by_markdown(document, output_path="markdown_chunks.txt"):
+def chunk_by_markdown(document, output_path="markdown_chunks.txt", store_path="markdown_chunks"):
     # チャンクを分割する際に使うMarkdownヘッダーを指定
     headers_to_split_on = [("#", "Header 1"), ("##", "Header 2")]
     # MarkdownHeaderTextSplitterを使用してチャンク化
@@ -58,12 +68,17 @@ def chunk_by_markdown(document, output_path="markdown_chunks.txt"):
         for i, doc in enumerate(docs, start=1):
             f.write(f"=== Chunk {i} ===\n")
             f.write(doc.page_content + "\n\n")
+    # チャンクストアにも書き出し(見出しのパスは「世界の歴史 > 古代文明」のように記録する)
+    with ChunkStoreWriter(store_path) as writer:
+        for doc in docs:
+            header_path = " > ".join(doc.metadata[name] for _, name in headers_to_split_on if name in doc.metadata)
+            writer.add(doc.page_content, source="markdown", header_path=header_path)
     # 完了メッセージを表示
-    print(f"Markdown-based chunks written to {output_path}")
+    print(f"Markdown-based chunks written to {output_path} and {store_path}")
 
 
 # セマンティックチャンク化を行う関数（LLMを使用、ファイル出力版）
-def chunk_by_semantics(document, output_path="semantic_chunks.txt"):
+def chunk_by_semantics(document, output_path="semantic_chunks.txt", store_path="semantic_chunks"):
     # .envファイルから環境変数を読み込む
     load_dotenv(verbose=True)
     # Azure OpenAI Embeddingsを使用してセマンティックに基づいたチャンク化を設定
@@ -78,8 +93,12 @@ def chunk_by_semantics(document, output_path="semantic_chunks.txt"):
         for i, doc in enumerate(docs, start=1):
             f.write(f"=== Chunk {i} ===\n")
             f.write(doc.page_content + "\n\n")
+    # チャンクストアにも書き出し
+    with ChunkStoreWriter(store_path) as writer:
+        for doc in docs:
+            writer.add(doc.page_content, source="semantic")
     # 完了メッセージを表示
-    print(f"Semantic chunks written to {output_path}")
+    print(f"Semantic chunks written to {output_path} and {store_path}")
 
 
 # メイン関数